@@ -28,10 +28,22 @@ DEEPSEEK_API_KEY = _get_env("DEEPSEEK_API_KEY", required=True)
 # DeepSeek API
 DEEPSEEK_API_URL = os.getenv("DEEPSEEK_API_URL", "https://api.deepseek.com/chat/completions")
 DEEPSEEK_MODEL = os.getenv("DEEPSEEK_MODEL", "deepseek-chat")
+# Сколько запросов к DeepSeek может быть в полёте одновременно (остальные ждут очереди)
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "16"))
 
 # CryptoBot (USDT only)
 CRYPTO_PAY_API_URL = os.getenv("CRYPTO_PAY_API_URL", "https://pay.crypt.bot/api/")
 CRYPTO_PAY_API_TOKEN = _get_env("CRYPTO_PAY_API_TOKEN", required=False)
+# Путь для webhook-уведомлений CryptoBot (invoice_paid); работает только в webhook-режиме
+CRYPTO_PAY_WEBHOOK_PATH = os.getenv("CRYPTO_PAY_WEBHOOK_PATH", "/crypto-pay/webhook")
+
+# Telegram webhook (если WEBHOOK_BASE_URL пуст — бот работает через long polling)
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+# Секрет для заголовка X-Telegram-Bot-Api-Secret-Token; пусто — генерируется при старте
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("PORT") or os.getenv("WEBAPP_PORT", "8080"))
 
 # Storage
 DATA_DIR = BASE_DIR / "data"
@@ -1,15 +1,26 @@
 from __future__ import annotations
 
 import asyncio
+import functools
+import json
 import logging
+import secrets
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import aclosing
 from datetime import datetime, timedelta
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Awaitable, Callable, Tuple, TypeVar
 
 from aiogram import Bot, Dispatcher, F, Router
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from aiogram.filters import CommandStart
 from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 
 from bot.config import (
     BOT_TOKEN,
@@ -22,20 +33,38 @@ from bot.config import (
     MAX_INPUT_TOKENS,
     SUBSCRIPTION_TARIFFS,
     REF_BASE_URL,
+    WEBHOOK_BASE_URL,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET,
+    WEBAPP_HOST,
+    WEBAPP_PORT,
+    CRYPTO_PAY_API_TOKEN,
+    CRYPTO_PAY_WEBHOOK_PATH,
 )
 import bot.config as app_config  # для доступа к REFERRAL_DAILY_BONUS
 
-from services.llm import ask_llm_stream, make_daily_summary
+from services.llm import ask_llm_stream, make_daily_summary, init_http, close_http
 from services.storage import Storage, UserRecord
-from services.payments import create_cryptobot_invoice, get_invoice_status
+from services.payments import (
+    create_cryptobot_invoice,
+    get_invoice_status,
+    verify_webhook_signature,
+    close_http as close_payments_http,
+)
 from services import texts as txt
 from services import metrics
 
+try:  # orjson в 2–5 раз быстрее stdlib json на типичных апдейтах Telegram
+    import orjson
+except ImportError:  # fallback на stdlib, если пакет не установлен
+    orjson = None  # type: ignore[assignment]
+
+try:  # uvloop (libuv) — быстрее стандартного event loop; на Windows недоступен
+    import uvloop
+except ImportError:
+    uvloop = None  # type: ignore[assignment]
+
 logger = logging.getLogger(__name__)
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
-)
 
 # --- Текст кнопок таскбара / режимов / подписки ---
 
@@ -57,6 +86,22 @@ BTN_SUB_3M = "💎 Premium · 3 месяца"
 BTN_SUB_12M = "💎 Premium · 12 месяцев"
 BTN_SUB_CHECK = "🔄 Проверить оплату"
 
+# Кнопка режима → mode_key из ASSISTANT_MODES
+MODE_BUTTON_TO_KEY: Dict[str, str] = {
+    BTN_MODE_UNIVERSAL: "universal",
+    BTN_MODE_MEDICINE: "medicine",
+    BTN_MODE_COACH: "coach",
+    BTN_MODE_BUSINESS: "business",
+    BTN_MODE_CREATIVE: "creative",
+}
+
+# Кнопка тарифа → tariff_key из SUBSCRIPTION_TARIFFS
+TARIFF_BUTTON_TO_KEY: Dict[str, str] = {
+    BTN_SUB_1M: "month_1",
+    BTN_SUB_3M: "month_3",
+    BTN_SUB_12M: "month_12",
+}
+
 # --- Разметка клавиатур (строго без инлайнов) ---
 
 MAIN_KB = ReplyKeyboardMarkup(
@@ -101,17 +146,131 @@ REF_KB = ReplyKeyboardMarkup(
     resize_keyboard=True,
 )
 
+
+def _make_session() -> AiohttpSession:
+    """HTTP-сессия бота: (де)сериализация апдейтов и запросов через orjson, если он есть."""
+    if orjson is None:
+        return AiohttpSession(json_loads=json.loads, json_dumps=json.dumps)
+    return AiohttpSession(
+        json_loads=orjson.loads,
+        json_dumps=lambda value: orjson.dumps(value).decode(),
+    )
+
+
+# Исходящие лимиты Telegram: ~30 сообщений/сек на бота и ~1 сообщение/сек на чат
+TG_GLOBAL_RATE = 30.0
+TG_CHAT_RATE = 1.0
+TG_CHAT_BURST = 3
+TG_CHAT_BUCKETS_MAX = 10_000
+
+
+class _TokenBucket:
+    """Token bucket: rate запросов в секунду, не больше burst подряд."""
+
+    __slots__ = ("rate", "burst", "tokens", "updated", "lock")
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = 0.0
+        self.lock = asyncio.Lock()
+
+    def _refill(self, now: float) -> None:
+        if self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self) -> None:
+        loop = asyncio.get_running_loop()
+        async with self.lock:
+            while True:
+                self._refill(loop.time())
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        """После 429: следующий токен появится не раньше чем через seconds."""
+        self._refill(asyncio.get_running_loop().time())
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+
+class _SendThrottle(BaseRequestMiddleware):
+    """
+    Все исходящие запросы с chat_id (answer, edit_text, ...) проходят через общий
+    и поканальный token bucket — всплески из разных хендлеров не ловят 429.
+    """
+
+    def __init__(self) -> None:
+        self._global = _TokenBucket(TG_GLOBAL_RATE, TG_GLOBAL_RATE)
+        self._chats: "OrderedDict[Any, _TokenBucket]" = OrderedDict()
+
+    def _chat_bucket(self, chat_id: Any) -> _TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = _TokenBucket(TG_CHAT_RATE, TG_CHAT_BURST)
+            if len(self._chats) > TG_CHAT_BUCKETS_MAX:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    async def __call__(
+        self,
+        make_request: Callable[[Bot, Any], Awaitable[Any]],
+        bot: Bot,
+        method: Any,
+    ) -> Any:
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return await make_request(bot, method)
+
+        bucket = self._chat_bucket(chat_id)
+        await bucket.acquire()
+        await self._global.acquire()
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter as e:
+            bucket.pause(e.retry_after)
+            raise
+
+
 bot = Bot(
     token=BOT_TOKEN,
+    session=_make_session(),
     default=DefaultBotProperties(parse_mode=ParseMode.MARKDOWN),
 )
+bot.session.middleware(_SendThrottle())
 dp = Dispatcher()
 router = Router()
 storage = Storage()
 
+# Все обращения к SQLite идут через один рабочий поток: event loop не блокируется
+# на IO/fsync, а единственное соединение Storage не используется из разных потоков
+_db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+
+T = TypeVar("T")
+
+
+# Как часто (сек) обновлять статистику SQLite для планировщика запросов
+DB_OPTIMIZE_INTERVAL = 3600
+
+# Стриминг: не чаще одного edit_text за этот интервал (сек) — хвост досылается в конце.
+# Telegram держит около 1 сообщения/сек на чат; чаще — ловим 429 RetryAfter
+STREAM_EDIT_INTERVAL = 1.2
+# Дольше этого (сек) на RetryAfter не ждём — финальный текст всё равно досылаем
+STREAM_RETRY_AFTER_CAP = 30.0
 
 # --- Вспомогательные функции ---
 
+async def _db(fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """Выполнить синхронный вызов Storage/metrics в потоке БД."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_executor, functools.partial(fn, *args, **kwargs))
+
+
 def _plan_title(plan_code: str, is_admin: bool) -> str:
     if is_admin or plan_code == "admin":
         return "Admin"
@@ -167,6 +326,34 @@ def _check_limits(user: UserRecord, plan_code: str, is_admin: bool) -> Optional[
     return None
 
 
+def _ensure_user_and_check_access(
+    user_id: int,
+    tg_user: Any,
+    text: str,
+) -> Tuple[UserRecord, str, Optional[str]]:
+    """
+    Один проход по БД на входящее сообщение (выполняется в потоке БД):
+    получить/создать пользователя, проверить лимиты и, если всё ок,
+    сразу залогировать сообщение — всё одной транзакцией.
+    Возвращает (user, plan_code, причина блокировки или None).
+    Дневной recap это не сдвигает: он читает только вчерашние сообщения.
+    """
+    with storage.transaction():
+        user, _ = storage.get_or_create_user(user_id, tg_user)
+        is_admin = storage.is_admin(user_id)
+        plan_code = storage.effective_plan(user, is_admin)
+
+        reason = _check_limits(user, plan_code, is_admin)
+        if not reason:
+            # Логируем входящее сообщение пользователя
+            try:
+                storage.log_message(user.id, "user", text)
+            except Exception as e:
+                logger.exception("Failed to log user message: %s", e)
+
+    return user, plan_code, reason
+
+
 def _today_key() -> str:
     return datetime.now().strftime("%Y-%m-%d")
 
@@ -192,16 +379,16 @@ async def _maybe_daily_summary(message: Message, user: UserRecord) -> None:
         return
 
     yesterday = _yesterday_key()
-    existing = storage.get_daily_summary(user.id, yesterday)
+    existing = await _db(storage.get_daily_summary, user.id, yesterday)
     if existing:
         user.last_summary_date = today
-        storage.save_user(user)
+        await _db(storage.save_user, user)
         return
 
-    texts_for_day = storage.get_messages_for_date(user.id, yesterday)
+    texts_for_day = await _db(storage.get_messages_for_date, user.id, yesterday)
     if not texts_for_day:
         user.last_summary_date = today
-        storage.save_user(user)
+        await _db(storage.save_user, user)
         return
 
     try:
@@ -209,23 +396,113 @@ async def _maybe_daily_summary(message: Message, user: UserRecord) -> None:
     except Exception as e:
         logger.exception("Failed to build daily summary: %s", e)
         user.last_summary_date = today
-        storage.save_user(user)
+        await _db(storage.save_user, user)
         return
 
     summary = (summary or "").strip()
     if not summary:
         user.last_summary_date = today
-        storage.save_user(user)
+        await _db(storage.save_user, user)
         return
 
-    storage.add_daily_summary(user.id, yesterday, summary)
     user.last_summary_date = today
-    storage.save_user(user)
+
+    def _store_summary() -> None:
+        with storage.transaction():
+            storage.add_daily_summary(user.id, yesterday, summary)
+            storage.save_user(user)
+
+    await _db(_store_summary)
 
     recap_text = txt.render_daily_recap(yesterday, summary)
     await message.answer(recap_text, reply_markup=MAIN_KB)
 
 
+# символы, при которых финальный текст стоит перерисовать в Markdown
+_MARKDOWN_CHARS = frozenset("*_`[")
+
+
+def _fit_telegram(text: str) -> str:
+    # защита от переполнения Телеграма
+    if len(text) > 4000:
+        return text[:3990] + "…"
+    return text
+
+
+async def _edit_stream_message(
+    typing_msg: Message,
+    full: str,
+    sent: str,
+    final: bool = False,
+) -> bool:
+    """
+    Обновляет «живое» сообщение. Возвращает False, если редактировать дальше нельзя.
+    Промежуточные правки — простым текстом: чанк может оборвать разметку на середине,
+    и Telegram отверг бы правку. Финальная — в Markdown, а если разметка битая,
+    один раз повторяем её без parse_mode.
+    Одинаковый после обрезки текст не отправляем — Telegram отвечает на него ошибкой.
+    """
+    shown = _fit_telegram(full)
+    if sent and shown == _fit_telegram(sent):
+        # финальный текст уже показан простым текстом — перерисовать стоит, только если есть разметка
+        if not (final and _MARKDOWN_CHARS.intersection(shown)):
+            return True
+    try:
+        if not final:
+            await typing_msg.edit_text(shown, parse_mode=None)
+        else:
+            try:
+                await typing_msg.edit_text(shown)
+            except TelegramBadRequest as e:
+                if "can't parse entities" not in str(e):
+                    raise
+                if shown != _fit_telegram(sent):
+                    await typing_msg.edit_text(shown, parse_mode=None)
+    except TelegramRetryAfter:
+        # решает вызывающий: переждать и дослать финальный текст
+        raise
+    except Exception as e:
+        logger.debug("Failed to edit message while streaming: %s", e)
+        return False
+    return True
+
+
+async def _finish_stream_message(
+    typing_msg: Message,
+    full: str,
+    sent: str,
+    retry_at: float,
+) -> None:
+    """
+    Финальный edit после стрима. Если Telegram ответил 429 — ждём retry_after
+    (не дольше STREAM_RETRY_AFTER_CAP) и пробуем ещё раз. Если правка так и не прошла,
+    досылаем ответ отдельным сообщением, чтобы он дошёл целиком.
+    """
+    loop = asyncio.get_running_loop()
+    for _ in range(2):
+        delay = retry_at - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        try:
+            if await _edit_stream_message(typing_msg, full, sent, final=True):
+                return
+            break
+        except TelegramRetryAfter as e:
+            retry_at = loop.time() + min(e.retry_after, STREAM_RETRY_AFTER_CAP)
+
+    logger.warning("Final stream edit failed, sending the answer as a new message")
+    delay = retry_at - loop.time()
+    if delay > 0:
+        await asyncio.sleep(delay)
+    shown = _fit_telegram(full)
+    try:
+        await typing_msg.answer(shown, reply_markup=MAIN_KB)
+    except TelegramBadRequest as e:
+        if "can't parse entities" not in str(e):
+            raise
+        await typing_msg.answer(shown, parse_mode=None, reply_markup=MAIN_KB)
+
+
 async def _send_streaming_answer(
     message: Message,
     user: UserRecord,
@@ -246,41 +523,68 @@ async def _send_streaming_answer(
 
     try:
         last_chunk: Dict[str, Any] | None = None
-
-        async for chunk in ask_llm_stream(
+        sent_text = ""
+        last_edit_at = 0.0
+        retry_at = 0.0  # после 429: до этого момента (loop.time) не редактируем
+        stream_broken = False
+        loop = asyncio.get_running_loop()
+
+        # aclosing: при обрыве стрима сразу закрываем запрос к LLM и освобождаем семафор
+        stream = ask_llm_stream(
             mode_key=user.mode_key or DEFAULT_MODE_KEY,
             user_prompt=text,
             style_hint=style_hint,
             is_premium=is_premium,
-        ):
-            last_chunk = chunk
-            full = chunk["full"]
-            # сохраняем полный текст для логирования
-            final_full_text = full
-
-            # защита от переполнения Телеграма
-            if len(full) > 4000:
-                full = full[:3990] + "…"
-
-            try:
-                await typing_msg.edit_text(full)
-            except Exception as e:
-                logger.debug("Failed to edit message while streaming: %s", e)
-                break
+        )
+        async with aclosing(stream):
+            async for chunk in stream:
+                last_chunk = chunk
+                # сохраняем полный текст для логирования
+                final_full_text = chunk["full"]
+
+                # Telegram попросил подождать — до конца окна промежуточные правки не шлём
+                now = loop.time()
+                if now < retry_at:
+                    continue
+
+                # редактируем не на каждый чанк, а не чаще раза в STREAM_EDIT_INTERVAL:
+                # меньше запросов к Telegram и меньше шансов упереться в flood-limit
+                if now - last_edit_at < STREAM_EDIT_INTERVAL:
+                    continue
+                last_edit_at = now
+
+                try:
+                    edited = await _edit_stream_message(typing_msg, final_full_text, sent_text)
+                except TelegramRetryAfter as e:
+                    retry_at = now + min(e.retry_after, STREAM_RETRY_AFTER_CAP)
+                    continue
+                if not edited:
+                    stream_broken = True
+                    break
+                sent_text = final_full_text
+
+        # добиваем хвост и рендерим разметку финальной правкой (после 429 — выждав паузу)
+        if not stream_broken and final_full_text:
+            await _finish_stream_message(typing_msg, final_full_text, sent_text, retry_at)
 
         tokens = last_chunk.get("tokens", 0) if last_chunk else 0
-        storage.apply_usage(user, tokens)
 
-        # Логируем финальный ответ ассистента в БД
-        if final_full_text:
-            try:
-                storage.log_message(user.id, "assistant", final_full_text)
-            except Exception as log_err:
-                logger.exception("Failed to log assistant message: %s", log_err)
+        def _finish_turn() -> None:
+            # Списание лимита и лог ответа ассистента — один коммит вместо двух
+            with storage.transaction():
+                storage.apply_usage(user, tokens)
+                if final_full_text:
+                    try:
+                        storage.log_message(user.id, "assistant", final_full_text)
+                    except Exception as log_err:
+                        logger.exception("Failed to log assistant message: %s", log_err)
+
+        await _db(_finish_turn)
 
         # Метрики: один ход диалога
         try:
-            metrics.log_chat_turn(
+            await _db(
+                metrics.log_chat_turn,
                 user_id=user.id,
                 mode_key=user.mode_key or DEFAULT_MODE_KEY,
                 request_text=text,
@@ -296,19 +600,14 @@ async def _send_streaming_answer(
         await typing_msg.edit_text(error_text)
         # Логируем текст ошибки как ответ ассистента
         try:
-            storage.log_message(user.id, "assistant", error_text)
+            await _db(storage.log_message, user.id, "assistant", error_text)
         except Exception as log_err:
             logger.exception("Failed to log assistant error message: %s", log_err)
 
 
 def _tariff_key_by_button(button_text: str) -> Optional[str]:
     """Маппинг текста кнопки → tariff_key из SUBSCRIPTION_TARIFFS."""
-    mapping = {
-        BTN_SUB_1M: "month_1",
-        BTN_SUB_3M: "month_3",
-        BTN_SUB_12M: "month_12",
-    }
-    return mapping.get(button_text)
+    return TARIFF_BUTTON_TO_KEY.get(button_text)
 
 
 # --- Хендлеры ---
@@ -320,13 +619,19 @@ async def cmd_start(message: Message) -> None:
     parts = full_text.split(maxsplit=1)
     start_param = parts[1].strip() if len(parts) > 1 else ""
 
-    user, created = storage.get_or_create_user(user_id, message.from_user)
+    def _start_user() -> Tuple[UserRecord, bool]:
+        # создание пользователя и реферальная привязка — одной транзакцией
+        with storage.transaction():
+            user, created = storage.get_or_create_user(user_id, message.from_user)
 
-    # Реферальный старт
-    if start_param.startswith("ref_") and created:
-        ref_code = start_param.replace("ref_", "", 1)
-        storage.apply_referral(user_id, ref_code)
-        user, _ = storage.get_or_create_user(user_id, message.from_user)
+            # Реферальный старт
+            if start_param.startswith("ref_") and created:
+                ref_code = start_param.replace("ref_", "", 1)
+                storage.apply_referral(user_id, ref_code)
+                user, _ = storage.get_or_create_user(user_id, message.from_user)
+        return user, created
+
+    user, created = await _db(_start_user)
 
     is_admin = storage.is_admin(user_id)
     plan_code = storage.effective_plan(user, is_admin)
@@ -351,15 +656,13 @@ async def cmd_start(message: Message) -> None:
     )
 
 
-@router.message(F.text == BTN_BACK_MAIN)
 async def on_back_main(message: Message) -> None:
     await message.answer("Возвращаю на главный экран.", reply_markup=MAIN_KB)
 
 
-@router.message(F.text == BTN_PROFILE)
 async def on_profile(message: Message) -> None:
     user_id = message.from_user.id
-    user, _ = storage.get_or_create_user(user_id, message.from_user)
+    user, _ = await _db(storage.get_or_create_user, user_id, message.from_user)
 
     is_admin = storage.is_admin(user_id)
     plan_code = storage.effective_plan(user, is_admin)
@@ -390,39 +693,20 @@ async def on_modes_root(message: Message) -> None:
     await message.answer(text_body, reply_markup=MODES_KB)
 
 
-@router.message(
-    F.text.in_(
-        {
-            BTN_MODE_UNIVERSAL,
-            BTN_MODE_MEDICINE,
-            BTN_MODE_COACH,
-            BTN_MODE_BUSINESS,
-            BTN_MODE_CREATIVE,
-        }
-    )
-)
 async def on_mode_select(message: Message) -> None:
     user_id = message.from_user.id
 
-    mapping = {
-        BTN_MODE_UNIVERSAL: "universal",
-        BTN_MODE_MEDICINE: "medicine",
-        BTN_MODE_COACH: "coach",
-        BTN_MODE_BUSINESS: "business",
-        BTN_MODE_CREATIVE: "creative",
-    }
-    mode_key = mapping.get(message.text, DEFAULT_MODE_KEY)
+    mode_key = MODE_BUTTON_TO_KEY.get(message.text, DEFAULT_MODE_KEY)
 
-    storage.set_mode(user_id, mode_key)
+    await _db(storage.set_mode, user_id, mode_key)
     mode_title = _mode_title(mode_key)
 
     await message.answer(txt.render_mode_switched(mode_title), reply_markup=MAIN_KB)
 
 
-@router.message(F.text == BTN_SUBSCRIPTION)
 async def on_subscription(message: Message) -> None:
     user_id = message.from_user.id
-    user, _ = storage.get_or_create_user(user_id, message.from_user)
+    user, _ = await _db(storage.get_or_create_user, user_id, message.from_user)
 
     is_admin = storage.is_admin(user_id)
     plan_code = storage.effective_plan(user, is_admin)
@@ -436,10 +720,9 @@ async def on_subscription(message: Message) -> None:
     await message.answer(text_body, reply_markup=SUB_KB)
 
 
-@router.message(F.text.in_({BTN_SUB_1M, BTN_SUB_3M, BTN_SUB_12M}))
 async def on_subscription_buy(message: Message) -> None:
     user_id = message.from_user.id
-    user, _ = storage.get_or_create_user(user_id, message.from_user)
+    user, _ = await _db(storage.get_or_create_user, user_id, message.from_user)
 
     tariff_key = _tariff_key_by_button(message.text)
     if not tariff_key:
@@ -458,11 +741,12 @@ async def on_subscription_buy(message: Message) -> None:
     invoice_id = invoice["invoice_id"]
     invoice_url = invoice["bot_invoice_url"]
 
-    storage.store_invoice(user, invoice_id=invoice_id, tariff_key=tariff_key)
+    await _db(storage.store_invoice, user, invoice_id=invoice_id, tariff_key=tariff_key)
 
     # Метрики: создание инвойса
     try:
-        metrics.log_invoice_created(
+        await _db(
+            metrics.log_invoice_created,
             user_id=user.id,
             tariff_key=tariff_key,
             invoice_id=invoice_id,
@@ -479,10 +763,9 @@ async def on_subscription_buy(message: Message) -> None:
     await message.answer(text_body, reply_markup=SUB_KB)
 
 
-@router.message(F.text == BTN_SUB_CHECK)
 async def on_subscription_check(message: Message) -> None:
     user_id = message.from_user.id
-    user, _ = storage.get_or_create_user(user_id, message.from_user)
+    user, _ = await _db(storage.get_or_create_user, user_id, message.from_user)
 
     invoice_id, tariff_key = storage.get_last_invoice(user)
     if not invoice_id or not tariff_key:
@@ -492,6 +775,14 @@ async def on_subscription_check(message: Message) -> None:
         )
         return
 
+    # Счёт уже засчитан (например, пришёл webhook) — в Crypto Pay не ходим
+    if await _db(storage.is_invoice_paid, invoice_id):
+        await message.answer(
+            txt.render_payment_check_result("paid"),
+            reply_markup=SUB_KB,
+        )
+        return
+
     status = await get_invoice_status(invoice_id)
     if not status:
         await message.answer(
@@ -503,11 +794,14 @@ async def on_subscription_check(message: Message) -> None:
     if status == "paid":
         tariff = SUBSCRIPTION_TARIFFS.get(tariff_key)
         months = int(tariff.get("months", 1)) if tariff else 1
-        storage.activate_premium(user, months)
+        # Отметка счёта и продление premium — одна транзакция; повторная проверка
+        # того же счёта (или уже пришедший webhook) premium не продлевает
+        await _db(storage.activate_paid_invoice, user, invoice_id, tariff_key, months)
 
     # Метрики: статус инвойса
     try:
-        metrics.log_invoice_status(
+        await _db(
+            metrics.log_invoice_status,
             user_id=user.id,
             tariff_key=tariff_key,
             invoice_id=invoice_id,
@@ -520,10 +814,9 @@ async def on_subscription_check(message: Message) -> None:
     await message.answer(text_body, reply_markup=SUB_KB)
 
 
-@router.message(F.text == BTN_REFERRALS)
 async def on_referrals(message: Message) -> None:
     user_id = message.from_user.id
-    user, _ = storage.get_or_create_user(user_id, message.from_user)
+    user, _ = await _db(storage.get_or_create_user, user_id, message.from_user)
 
     ref_link = f"{REF_BASE_URL}?start=ref_{user.ref_code}"
 
@@ -535,6 +828,24 @@ async def on_referrals(message: Message) -> None:
     await message.answer(text_body, reply_markup=REF_KB)
 
 
+# Кнопки с точным текстом: один фильтр в роутере (проверка по frozenset) и выбор
+# обработчика по словарю — обычное сообщение не прогоняется через цепочку F.text == ...
+_BUTTON_HANDLERS: Dict[str, Callable[[Message], Awaitable[None]]] = {
+    BTN_BACK_MAIN: on_back_main,
+    BTN_PROFILE: on_profile,
+    **{btn: on_mode_select for btn in MODE_BUTTON_TO_KEY},
+    BTN_SUBSCRIPTION: on_subscription,
+    **{btn: on_subscription_buy for btn in TARIFF_BUTTON_TO_KEY},
+    BTN_SUB_CHECK: on_subscription_check,
+    BTN_REFERRALS: on_referrals,
+}
+
+
+@router.message(F.text.in_(frozenset(_BUTTON_HANDLERS)))
+async def on_button(message: Message) -> None:
+    await _BUTTON_HANDLERS[message.text](message)
+
+
 @router.message(F.text.startswith("/"))
 async def on_unknown_command(message: Message) -> None:
     await message.answer(
@@ -555,13 +866,9 @@ async def on_user_message(message: Message) -> None:
         await message.answer(txt.render_too_long_prompt_error(), reply_markup=MAIN_KB)
         return
 
-    user_id = message.from_user.id
-    user, _ = storage.get_or_create_user(user_id, message.from_user)
-
-    is_admin = storage.is_admin(user_id)
-    plan_code = storage.effective_plan(user, is_admin)
-
-    reason = _check_limits(user, plan_code, is_admin)
+    user, plan_code, reason = await _db(
+        _ensure_user_and_check_access, message.from_user.id, message.from_user, text
+    )
     if reason:
         await message.answer(
             txt.render_limits_warning(reason),
@@ -569,7 +876,8 @@ async def on_user_message(message: Message) -> None:
         )
         # Метрики: ударились в лимит
         try:
-            metrics.log_limit_hit(
+            await _db(
+                metrics.log_limit_hit,
                 user_id=user.id,
                 plan_code=plan_code,
                 reason=reason,
@@ -583,19 +891,155 @@ async def on_user_message(message: Message) -> None:
     # Авто-рефлексия: если новый день — аккуратно подводим итоги вчера
     await _maybe_daily_summary(message, user)
 
-    # Логируем входящее сообщение пользователя
+    await _send_streaming_answer(message, user, text, plan_code)
+
+
+async def on_cryptopay_webhook(request: web.Request) -> web.Response:
+    """
+    Webhook CryptoBot: на invoice_paid сразу активируем premium и пишем пользователю,
+    не дожидаясь, пока он нажмёт «Проверить оплату».
+    """
+    body = await request.read()
+    if not verify_webhook_signature(body, request.headers.get("crypto-pay-api-signature", "")):
+        return web.Response(status=401)
+
     try:
-        storage.log_message(user.id, "user", text)
-    except Exception as e:
-        logger.exception("Failed to log user message: %s", e)
+        update = json.loads(body)
+    except ValueError:
+        return web.Response(status=400)
+    if not isinstance(update, dict):
+        return web.Response(status=400)
+
+    if update.get("update_type") != "invoice_paid":
+        return web.Response(text="ok")
+
+    invoice = update.get("payload") or {}
+    if not isinstance(invoice, dict):
+        return web.Response(status=400)
+    invoice_id = invoice.get("invoice_id")
+    if not invoice_id:
+        return web.Response(text="ok")
+
+    found = await _db(storage.find_invoice, int(invoice_id))
+    if found is None:
+        logger.warning("CryptoBot webhook: unknown invoice %s", invoice_id)
+        return web.Response(text="ok")
+
+    # тариф берём из записи счёта: пользователь мог с тех пор выставить другой счёт
+    user, tariff_key = found
+    tariff = SUBSCRIPTION_TARIFFS.get(tariff_key or "")
+    months = int(tariff.get("months", 1)) if tariff else 1
+    activated = await _db(
+        storage.activate_paid_invoice, user, int(invoice_id), tariff_key, months
+    )
+    if not activated:
+        # Повторная доставка того же апдейта — premium уже начислен
+        return web.Response(text="ok")
 
-    await _send_streaming_answer(message, user, text, plan_code)
+    try:
+        await _db(
+            metrics.log_invoice_status,
+            user_id=user.id,
+            tariff_key=tariff_key,
+            invoice_id=int(invoice_id),
+            status="paid",
+        )
+    except Exception as m_err:
+        logger.exception("Failed to log invoice_status metrics: %s", m_err)
+
+    try:
+        # premium уже начислен — медленный Telegram не должен держать ответ CryptoBot
+        await asyncio.wait_for(
+            bot.send_message(
+                user.id,
+                txt.render_payment_check_result("paid"),
+                reply_markup=MAIN_KB,
+            ),
+            timeout=8,
+        )
+    except Exception as send_err:
+        logger.warning("Failed to notify user %s about payment: %s", user.id, send_err)
+
+    return web.Response(text="ok")
+
+
+async def _run_webhook() -> None:
+    """
+    Режим webhook: Telegram сам присылает апдейты POST-запросом на WEBHOOK_PATH,
+    без цикла getUpdates. Работает, пока процесс не остановят.
+    """
+    # без секрета любой, кто знает WEBHOOK_PATH, мог бы прислать поддельный апдейт
+    # от имени любого пользователя: если WEBHOOK_SECRET не задан — случайный на процесс,
+    # Telegram получает его в set_webhook при каждом старте
+    secret_token = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+
+    app = web.Application()
+    # каждый апдейт обрабатывается отдельной задачей: Telegram сразу получает 200,
+    # а долгий ответ LLM одному пользователю не задерживает кнопки других
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        handle_in_background=True,
+        secret_token=secret_token,
+    ).register(app, path=WEBHOOK_PATH)
+    if CRYPTO_PAY_API_TOKEN:
+        app.router.add_post(CRYPTO_PAY_WEBHOOK_PATH, on_cryptopay_webhook)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host=WEBAPP_HOST, port=WEBAPP_PORT)
+    await site.start()
+
+    await bot.set_webhook(
+        WEBHOOK_BASE_URL + WEBHOOK_PATH,
+        secret_token=secret_token,
+    )
+    logger.info("Webhook server listening on %s:%s%s", WEBAPP_HOST, WEBAPP_PORT, WEBHOOK_PATH)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await bot.delete_webhook()
+        await runner.cleanup()
+
+
+async def _db_maintenance_loop() -> None:
+    """Раз в DB_OPTIMIZE_INTERVAL — PRAGMA optimize в потоке БД (между обычными запросами)."""
+    while True:
+        await asyncio.sleep(DB_OPTIMIZE_INTERVAL)
+        try:
+            await _db(storage.optimize)
+        except Exception as e:
+            logger.warning("Periodic PRAGMA optimize failed: %s", e)
 
 
 async def main() -> None:
     dp.include_router(router)
-    await dp.start_polling(bot)
+    await init_http()
+    maintenance_task = asyncio.create_task(_db_maintenance_loop())
+    try:
+        if WEBHOOK_BASE_URL:
+            await _run_webhook()
+        else:
+            # handle_as_tasks: апдейты из одной пачки getUpdates обрабатываются параллельно
+            await dp.start_polling(bot, handle_as_tasks=True)
+    finally:
+        maintenance_task.cancel()
+        await close_http()
+        await close_payments_http()
+        await _db(storage.close)
+        await _db(metrics.close)
+        _db_executor.shutdown(wait=True)
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    # root-логгер настраиваем только при запуске, а не при импорте модуля
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
+    )
+    if uvloop is not None:
+        # свой loop только для main(), без глобальной event loop policy (install() устарел с 3.12)
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
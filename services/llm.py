@@ -1,8 +1,14 @@
 from __future__ import annotations
 
+import asyncio
+import functools
+import json
 import logging
+import random
+import re
+from contextlib import aclosing
 from dataclasses import dataclass
-from typing import Any, AsyncIterator, Dict, List, Optional
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
 
 import httpx
 
@@ -21,6 +27,53 @@ DEEPSEEK_HEAVY_MODEL: str = getattr(config, "DEEPSEEK_HEAVY_MODEL", DEFAULT_MODE
 ASSISTANT_MODES: Dict[str, Dict[str, Any]] = getattr(config, "ASSISTANT_MODES", {})
 DEFAULT_MODE_KEY: str = getattr(config, "DEFAULT_MODE_KEY", "universal")
 
+# Общий HTTP-клиент для DeepSeek: держим тёплые TLS-соединения между запросами
+_HTTP_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=32)
+_HTTP_TIMEOUT = 60.0
+
+_client: Optional[httpx.AsyncClient] = None
+
+# Ограничение одновременных запросов к DeepSeek: всплеск трафика ждёт в очереди,
+# а не упирается в rate limit провайдера
+_LLM_SEMAPHORE = asyncio.Semaphore(int(getattr(config, "LLM_CONCURRENCY", 16)))
+
+# Повторы на 429/5xx и обрыве соединения (таймаут не повторяем — пользователь и так ждал)
+_RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+_RETRY_ATTEMPTS = 3
+_RETRY_BASE_DELAY = 0.5
+_RETRY_MAX_DELAY = 20.0
+
+# Стрим от DeepSeek приходит по нескольку символов — наружу отдаём пачками не меньше этого
+_STREAM_MIN_DELTA = 64
+
+
+def _get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(limits=_HTTP_LIMITS, timeout=_HTTP_TIMEOUT)
+    return _client
+
+
+async def init_http() -> None:
+    """
+    Создаёт общий клиент и заранее открывает соединение с DeepSeek,
+    чтобы первый пользовательский запрос не платил за TLS-рукопожатие.
+    """
+    client = _get_client()
+    if not DEEPSEEK_API_URL:
+        return
+    try:
+        await client.head(DEEPSEEK_API_URL, timeout=10.0)
+    except Exception as e:
+        logger.warning("Failed to warm up DeepSeek connection: %s", e)
+
+
+async def close_http() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
 
 @dataclass
 class Intent:
@@ -44,6 +97,32 @@ def _estimate_tokens(text: str) -> int:
     return max(1, len(text) // 4)
 
 
+def _keywords_re(words: List[str]) -> "re.Pattern[str]":
+    """Одна скомпилированная альтернатива вместо цикла any(w in text ...): поиск идёт в C."""
+    return re.compile("|".join(re.escape(w) for w in words))
+
+
+# Категории проверяются по порядку — первая совпавшая побеждает
+_INTENT_PATTERNS: Tuple[Tuple[str, "re.Pattern[str]"], ...] = (
+    ("plan", _keywords_re(["план", "структурируй", "шаги", "чек-лист", "чеклист"])),
+    ("brainstorm", _keywords_re(["вариант", "варианты", "брейншторм", "идея", "идеи"])),
+    (
+        "emotional",
+        _keywords_re(["чувствую", "переживаю", "тревога", "стресс", "перегруз", "не знаю что делать"]),
+    ),
+    ("question", _keywords_re(["почему", "зачем", "как", "что такое", "что делать", "?"])),
+    ("reflection", _keywords_re(["рефлексия", "подведи итоги", "подытожим", "итоги дня"])),
+)
+
+_EMOTION_PATTERNS: Tuple[Tuple[str, "re.Pattern[str]"], ...] = (
+    ("overload", _keywords_re(["перегруз", "слишком много", "не успеваю", "устал", "голова кипит"])),
+    ("anxiety", _keywords_re(["тревога", "переживаю", "волнует", "страх", "нервничаю"])),
+    ("anger", _keywords_re(["злюсь", "бесит", "раздражает", "ненавижу"])),
+    ("inspired", _keywords_re(["заряжен", "вдохновлен", "вдохновлён", "кайф", "огонь"])),
+    ("apathy", _keywords_re(["апатия", "пусто", "ничего не хочется", "нет сил"])),
+)
+
+
 def analyze_intent(message_text: str) -> Intent:
     """
     Лёгкий анализ интента для дальнейшей маршрутизации.
@@ -53,18 +132,11 @@ def analyze_intent(message_text: str) -> Intent:
     is_long = len(text) > 300
 
     # очень грубые эвристики
-    if any(w in text for w in ["план", "структурируй", "шаги", "чек-лист", "чеклист"]):
-        kind = "plan"
-    elif any(w in text for w in ["вариант", "варианты", "брейншторм", "идея", "идеи"]):
-        kind = "brainstorm"
-    elif any(w in text for w in ["чувствую", "переживаю", "тревога", "стресс", "перегруз", "не знаю что делать"]):
-        kind = "emotional"
-    elif any(w in text for w in ["почему", "зачем", "как", "что такое", "что делать", "?"]):
-        kind = "question"
-    elif any(w in text for w in ["рефлексия", "подведи итоги", "подытожим", "итоги дня"]):
-        kind = "reflection"
-    else:
-        kind = "other"
+    kind = "other"
+    for name, pattern in _INTENT_PATTERNS:
+        if pattern.search(text):
+            kind = name
+            break
 
     return Intent(kind=kind, is_long=is_long, raw_text=message_text)
 
@@ -77,25 +149,9 @@ def _detect_emotion(message_text: str) -> str:
     """
     text = (message_text or "").strip().lower()
 
-    overload_words = ["перегруз", "слишком много", "не успеваю", "устал", "голова кипит"]
-    anxiety_words = ["тревога", "переживаю", "волнует", "страх", "нервничаю"]
-    anger_words = ["злюсь", "бесит", "раздражает", "ненавижу"]
-    inspired_words = ["заряжен", "вдохновлен", "вдохновлён", "кайф", "огонь"]
-    apathy_words = ["апатия", "пусто", "ничего не хочется", "нет сил"]
-
-    def _has(words: List[str]) -> bool:
-        return any(w in text for w in words)
-
-    if _has(overload_words):
-        return "overload"
-    if _has(anxiety_words):
-        return "anxiety"
-    if _has(anger_words):
-        return "anger"
-    if _has(inspired_words):
-        return "inspired"
-    if _has(apathy_words):
-        return "apathy"
+    for tag, pattern in _EMOTION_PATTERNS:
+        if pattern.search(text):
+            return tag
     return "neutral"
 
 
@@ -121,6 +177,9 @@ def _select_model_for_prompt(intent: Intent, mode_key: str) -> str:
     return DEEPSEEK_LIGHT_MODEL
 
 
+# Аргументы — короткие строки и флаг, режимы из конфига не меняются после старта:
+# одинаковый промпт для (режим, стиль, эмоция, тариф) собираем один раз
+@functools.lru_cache(maxsize=512)
 def _build_system_prompt(
     mode_key: str,
     style_hint: str,
@@ -185,7 +244,9 @@ def _build_system_prompt(
             "- не растекайся: максимум смысла на единицу текста, минимум воды."
         )
 
-    parts = [base_prompt, behavior_rules, style_suffix, emotion_suffix, premium_suffix]
+    # Сначала то, что одинаково для всех пользователей режима (и тарифа), потом персональное:
+    # общий префикс промпта попадает в prompt cache DeepSeek — дешевле и быстрее первый токен
+    parts = [base_prompt, behavior_rules, premium_suffix, style_suffix, emotion_suffix]
     final = "\n\n".join(p for p in parts if p)
     if not final:
         final = (
@@ -195,6 +256,47 @@ def _build_system_prompt(
     return final
 
 
+def _retry_after(resp: httpx.Response) -> Optional[float]:
+    """Retry-After в секундах, если провайдер его прислал (HTTP-дату не разбираем)."""
+    value = resp.headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+
+async def _post_with_retries(payload: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, Any]:
+    """
+    POST в DeepSeek под семафором; на 429/5xx и ошибке соединения — повтор
+    с экспоненциальной задержкой (full jitter) или по Retry-After.
+    Семафор не держится во время ожидания между попытками.
+    """
+    for attempt in range(_RETRY_ATTEMPTS):
+        last_attempt = attempt == _RETRY_ATTEMPTS - 1
+        try:
+            async with _LLM_SEMAPHORE:
+                resp = await _get_client().post(DEEPSEEK_API_URL, json=payload, headers=headers)
+            resp.raise_for_status()
+            return resp.json()
+        except httpx.HTTPStatusError as e:
+            if last_attempt or e.response.status_code not in _RETRY_STATUSES:
+                raise
+            delay = _retry_after(e.response)
+        except (httpx.ConnectError, httpx.RemoteProtocolError):
+            if last_attempt:
+                raise
+            delay = None
+
+        if delay is None:
+            delay = random.uniform(0, _RETRY_BASE_DELAY * 2 ** attempt)
+        delay = min(delay, _RETRY_MAX_DELAY)
+        logger.warning("DeepSeek transient error, retry %s in %.2fs", attempt + 1, delay)
+        await asyncio.sleep(delay)
+    raise RuntimeError("unreachable")
+
+
 async def _call_deepseek(
     messages: List[Dict[str, str]],
     model: Optional[str] = None,
@@ -225,10 +327,7 @@ async def _call_deepseek(
         "Content-Type": "application/json",
     }
 
-    async with httpx.AsyncClient(timeout=60.0) as client:
-        resp = await client.post(DEEPSEEK_API_URL, json=payload, headers=headers)
-        resp.raise_for_status()
-        data = resp.json()
+    data = await _post_with_retries(payload, headers)
 
     try:
         content = data["choices"][0]["message"]["content"]
@@ -247,38 +346,92 @@ async def _call_deepseek(
     }
 
 
-def _split_into_chunks(text: str, target_size: int = 400) -> List[str]:
+async def _stream_deepseek(
+    messages: List[Dict[str, str]],
+    model: Optional[str] = None,
+    temperature: float = 0.7,
+    max_tokens: int = 1024,
+) -> AsyncIterator[Tuple[str, int]]:
     """
-    Делит текст на смысловые чанки:
-    - сначала по двойным переносам (абзацы),
-    - если абзац слишком длинный — режем его дополнительно.
+    Потоковый вызов DeepSeek Chat Completion (SSE, stream=True).
+    Отдаёт пары (кусок текста, total_tokens); total_tokens ненулевой только в последней паре.
+    Повторы на 429/5xx и обрыве соединения — как в _post_with_retries, но только пока
+    не пришёл первый кусок: после этого повтор продублировал бы текст.
     """
-    text = (text or "").strip()
-    if not text:
-        return []
-
-    paragraphs = [p.strip() for p in text.split("\n\n") if p.strip()]
-    chunks: List[str] = []
-
-    for para in paragraphs:
-        if len(para) <= target_size:
-            chunks.append(para)
-        else:
-            # режем длинный абзац на куски по target_size
-            start = 0
-            while start < len(para):
-                end = start + target_size
-                chunks.append(para[start:end])
-                start = end
-
-    # добавим двойной перенос между чанками, чтобы сохранялась структура
-    merged: List[str] = []
-    for i, ch in enumerate(chunks):
-        if i == 0:
-            merged.append(ch)
-        else:
-            merged.append("\n\n" + ch)
-    return merged
+    if not DEEPSEEK_API_KEY or not DEEPSEEK_API_URL:
+        raise RuntimeError("DeepSeek API не настроен: DEEPSEEK_API_KEY/DEEPSEEK_API_URL пустые.")
+
+    payload: Dict[str, Any] = {
+        "model": model or DEFAULT_MODEL,
+        "messages": messages,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "stream": True,
+        "stream_options": {"include_usage": True},
+    }
+    headers = {
+        "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
+        "Content-Type": "application/json",
+    }
+
+    started = False
+    for attempt in range(_RETRY_ATTEMPTS):
+        last_attempt = attempt == _RETRY_ATTEMPTS - 1
+        try:
+            client = _get_client()
+            request = client.build_request("POST", DEEPSEEK_API_URL, json=payload, headers=headers)
+            # Слот держим до закрытия тела ответа: провайдер генерирует всё это время,
+            # и LLM_CONCURRENCY ограничивает именно число одновременных генераций
+            async with _LLM_SEMAPHORE:
+                resp = await client.send(request, stream=True)
+                try:
+                    if resp.is_error:
+                        await resp.aread()
+                        resp.raise_for_status()
+
+                    content_len = 0
+                    total_tokens: Optional[int] = None
+                    async for line in resp.aiter_lines():
+                        if not line.startswith("data:"):
+                            continue
+                        data = line[5:].strip()
+                        if data == "[DONE]":
+                            break
+                        try:
+                            event = json.loads(data)
+                        except ValueError:
+                            # keep-alive/обрезанная строка — пропускаем, а не рвём весь ответ
+                            continue
+                        usage = event.get("usage") or {}
+                        if usage:
+                            total_tokens = usage.get("total_tokens") or usage.get("completion_tokens")
+                        for choice in event.get("choices") or ():
+                            delta = (choice.get("delta") or {}).get("content")
+                            if delta:
+                                started = True
+                                content_len += len(delta)
+                                yield delta, 0
+
+                    if total_tokens is None:
+                        total_tokens = max(1, content_len // 4)
+                    yield "", int(total_tokens)
+                    return
+                finally:
+                    await resp.aclose()
+        except httpx.HTTPStatusError as e:
+            if last_attempt or e.response.status_code not in _RETRY_STATUSES:
+                raise
+            delay = _retry_after(e.response)
+        except (httpx.ConnectError, httpx.RemoteProtocolError):
+            if started or last_attempt:
+                raise
+            delay = None
+
+        if delay is None:
+            delay = random.uniform(0, _RETRY_BASE_DELAY * 2 ** attempt)
+        delay = min(delay, _RETRY_MAX_DELAY)
+        logger.warning("DeepSeek transient error, retry %s in %.2fs", attempt + 1, delay)
+        await asyncio.sleep(delay)
 
 
 async def ask_llm_stream(
@@ -292,8 +445,8 @@ async def ask_llm_stream(
     - анализирует интент и эмоцию,
     - выбирает модель,
     - собирает системный промпт (для премиум — «стратегический мозг»),
-    - делает один запрос к DeepSeek,
-    - режет ответ на чанки и стримит их наружу.
+    - делает потоковый запрос к DeepSeek и отдаёт текст наружу по мере генерации
+      (пачками от _STREAM_MIN_DELTA символов или до конца строки).
     Каждая итерация возвращает dict:
       {
         "delta": <последний чанк>,
@@ -320,26 +473,33 @@ async def ask_llm_stream(
     # Премиум получает больший лимит токенов на ответ
     max_tokens = 2048 if is_premium else 1024
 
-    result = await _call_deepseek(messages, model=model_name, max_tokens=max_tokens)
-    full_text = result["content"]
-    total_tokens = result["total_tokens"]
-
-    chunks = _split_into_chunks(full_text)
-    if not chunks:
-        # даже если LLM вернул пустоту, возвращаем один пустой чанк
-        yield {"delta": "", "full": "", "tokens": total_tokens}
-        return
-
     assembled = ""
-    for i, ch in enumerate(chunks):
-        assembled += ch
-        # только на последнем чанке передаём количество токенов
-        tokens = total_tokens if i == len(chunks) - 1 else 0
-        yield {
-            "delta": ch,
-            "full": assembled,
-            "tokens": tokens,
-        }
+    pending: List[str] = []
+    pending_len = 0
+    stream = _stream_deepseek(messages, model=model_name, max_tokens=max_tokens)
+    async with aclosing(stream):
+        async for piece, total_tokens in stream:
+            if piece:
+                pending.append(piece)
+                pending_len += len(piece)
+                if pending_len < _STREAM_MIN_DELTA and "\n" not in piece:
+                    continue
+
+            delta = "".join(pending)
+            pending.clear()
+            pending_len = 0
+            assembled += delta
+            full = assembled.strip()
+            # пустой текст Telegram не примет — ждём первых непробельных символов;
+            # количество токенов известно только в конце и приходит последней пачкой
+            # (даже если LLM вернул пустоту, наружу уйдёт один пустой чанк)
+            if not full and not total_tokens:
+                continue
+            yield {
+                "delta": delta,
+                "full": full,
+                "tokens": total_tokens,
+            }
 
 
 async def make_daily_summary(messages_texts: List[str]) -> str:
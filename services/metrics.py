@@ -3,6 +3,7 @@ from __future__ import annotations
 import json
 import logging
 import sqlite3
+import threading
 import time
 from pathlib import Path
 from typing import Any, Dict, Optional
@@ -19,11 +20,34 @@ except Exception:
 
 _INITIALIZED = False
 
+# Одно соединение на процесс: без переоткрытия файла и разбора схемы на каждое событие.
+# Запись идёт под блокировкой — соединение можно звать из любого потока
+_conn: Optional[sqlite3.Connection] = None
+_conn_lock = threading.Lock()
+
 
 def _get_conn() -> sqlite3.Connection:
-    conn = sqlite3.connect(str(METRICS_DB_PATH))
-    conn.row_factory = sqlite3.Row
-    return conn
+    global _conn
+    if _conn is None:
+        conn = sqlite3.connect(
+            str(METRICS_DB_PATH),
+            check_same_thread=False,
+            cached_statements=64,
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        _conn = conn
+    return _conn
+
+
+def close() -> None:
+    """Закрывает общее соединение метрик (при остановке бота)."""
+    global _conn
+    with _conn_lock:
+        if _conn is not None:
+            _conn.close()
+            _conn = None
 
 
 def _ensure_schema() -> None:
@@ -31,7 +55,14 @@ def _ensure_schema() -> None:
     if _INITIALIZED:
         return
 
-    conn = _get_conn()
+    with _conn_lock:
+        _create_schema(_get_conn())
+    _INITIALIZED = True
+
+
+def _create_schema(conn: sqlite3.Connection) -> None:
+    # WAL сохраняется в файле БД: включаем один раз при инициализации схемы
+    conn.execute("PRAGMA journal_mode=WAL")
     cur = conn.cursor()
     cur.execute(
         """
@@ -61,8 +92,6 @@ def _ensure_schema() -> None:
         "ON metrics_events(user_id, ts)"
     )
     conn.commit()
-    conn.close()
-    _INITIALIZED = True
 
 
 def _insert_event(
@@ -97,45 +126,53 @@ def _insert_event(
         "extra": extra,
     }
 
-    conn = _get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT INTO metrics_events (
-            ts,
-            user_id,
-            event_type,
-            intent_type,
-            mode_key,
-            request_len,
-            response_len,
-            plan_code,
-            tariff_key,
-            invoice_id,
-            status,
-            extra_json
-        )
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """,
-        (
-            ts,
-            user_id,
-            event_type,
-            intent_type,
-            mode_key,
-            request_len,
-            response_len,
-            plan_code,
-            tariff_key,
-            invoice_id,
-            status,
-            json.dumps(extra, ensure_ascii=False),
-        ),
-    )
-    conn.commit()
-    conn.close()
-
-    # Структурный лог в текстовый лог — удобно парсить потом
+    with _conn_lock:
+        conn = _get_conn()
+        try:
+            cur = conn.cursor()
+            cur.execute(
+                """
+                INSERT INTO metrics_events (
+                    ts,
+                    user_id,
+                    event_type,
+                    intent_type,
+                    mode_key,
+                    request_len,
+                    response_len,
+                    plan_code,
+                    tariff_key,
+                    invoice_id,
+                    status,
+                    extra_json
+                )
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    ts,
+                    user_id,
+                    event_type,
+                    intent_type,
+                    mode_key,
+                    request_len,
+                    response_len,
+                    plan_code,
+                    tariff_key,
+                    invoice_id,
+                    status,
+                    json.dumps(extra, ensure_ascii=False),
+                ),
+            )
+            conn.commit()
+        except Exception:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+
+    # Структурный лог в текстовый лог — удобно парсить потом.
+    # json.dumps не ленивый, поэтому сериализуем только если INFO реально пишется
+    if not logger.isEnabledFor(logging.INFO):
+        return
     try:
         logger.info("metrics_event %s", json.dumps(payload, ensure_ascii=False))
     except Exception:
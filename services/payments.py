@@ -1,31 +1,77 @@
 from __future__ import annotations
 
+import hashlib
+import hmac
 import logging
 from typing import Dict, Any, Optional
 
 import httpx
 
+try:  # orjson сериализует сразу в bytes и в разы быстрее stdlib json
+    import orjson
+except ImportError:  # fallback на stdlib (httpx сам сериализует json=...)
+    orjson = None  # type: ignore[assignment]
+
+try:  # пакет h2 (ставится с httpx[http2]) — все запросы к Crypto Pay мультиплексируются в одно соединение
+    import h2  # noqa: F401
+    _HTTP2 = True
+except ImportError:
+    _HTTP2 = False
+
 from bot.config import CRYPTO_PAY_API_URL, CRYPTO_PAY_API_TOKEN, SUBSCRIPTION_TARIFFS
 
 logger = logging.getLogger(__name__)
 
+# Таймаут вызова Crypto Pay (на подключение, отправку, чтение и ожидание соединения из пула).
+# Задаётся на клиенте: отмена через asyncio.wait_for выбрасывала бы соединение из пула
+CRYPTO_PAY_DEADLINE = 10.0
+
+
+# Один клиент на процесс: без нового TCP+TLS-рукопожатия с pay.crypt.bot на каждый счёт
+_client: Optional[httpx.AsyncClient] = None
+
+
+def _get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            base_url=CRYPTO_PAY_API_URL.rstrip("/") + "/",
+            headers={
+                "Crypto-Pay-API-Token": CRYPTO_PAY_API_TOKEN,
+                "Content-Type": "application/json",
+            },
+            timeout=httpx.Timeout(CRYPTO_PAY_DEADLINE),
+            # всплеск нажатий «купить» не должен закрывать лишние соединения сразу после ответа
+            limits=httpx.Limits(max_keepalive_connections=32),
+            http2=_HTTP2,
+        )
+    return _client
+
+
+async def close_http() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
 
 async def _cryptopay_request(method: str, payload: Dict[str, Any]) -> Dict[str, Any]:
     if not CRYPTO_PAY_API_TOKEN:
         raise RuntimeError("CRYPTO_PAY_API_TOKEN is not configured")
 
-    headers = {
-        "Crypto-Pay-API-Token": CRYPTO_PAY_API_TOKEN,
-    }
-
-    url = CRYPTO_PAY_API_URL.rstrip("/") + f"/{method}"
-    async with httpx.AsyncClient(timeout=20.0) as client:
-        resp = await client.post(url, headers=headers, json=payload)
-        resp.raise_for_status()
-        data = resp.json()
-        if not data.get("ok"):
-            raise RuntimeError(f"CryptoPay API error: {data}")
-        return data["result"]
+    try:
+        if orjson is not None:
+            resp = await _get_client().post(method, content=orjson.dumps(payload))
+        else:
+            resp = await _get_client().post(method, json=payload)
+    except httpx.TimeoutException:
+        logger.warning("CryptoPay %s timed out after %.0fs", method, CRYPTO_PAY_DEADLINE)
+        raise
+    resp.raise_for_status()
+    data = orjson.loads(resp.content) if orjson is not None else resp.json()
+    if not data.get("ok"):
+        raise RuntimeError(f"CryptoPay API error: {data}")
+    return data["result"]
 
 
 async def create_cryptobot_invoice(tariff_key: str) -> Optional[Dict[str, Any]]:
@@ -60,14 +106,28 @@ async def get_invoice_status(invoice_id: int) -> Optional[str]:
     Возвращает строку статуса (active/paid/cancelled/expired) или None.
     """
     payload = {
-        "invoice_ids": [invoice_id],
+        "invoice_ids": str(invoice_id),
     }
     try:
         result = await _cryptopay_request("getInvoices", payload)
-        if not result:
+        # getInvoices отдаёт либо {"items": [...]}, либо голый список — поддерживаем оба варианта
+        items = result.get("items", []) if isinstance(result, dict) else result
+        if not items:
             return None
-        invoice = result[0]
+        invoice = items[0]
         return invoice.get("status")
     except Exception as e:
         logger.exception("Failed to get CryptoBot invoice status: %s", e)
         return None
+
+
+def verify_webhook_signature(body: bytes, signature: str) -> bool:
+    """
+    Проверка подписи webhook-апдейта CryptoBot:
+    HMAC-SHA256 от сырого тела, ключ — SHA256 от API-токена (заголовок crypto-pay-api-signature).
+    """
+    if not CRYPTO_PAY_API_TOKEN or not signature:
+        return False
+    secret = hashlib.sha256(CRYPTO_PAY_API_TOKEN.encode()).digest()
+    expected = hmac.new(secret, body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature)
@@ -1,14 +1,17 @@
 from __future__ import annotations
 
+import copy
 import json
 import logging
 import os
 import sqlite3
 import time
+from collections import OrderedDict
+from contextlib import contextmanager
 from dataclasses import dataclass
 from datetime import datetime, date, timedelta
 from pathlib import Path
-from typing import Optional, Tuple, List, Dict, Any
+from typing import Optional, Tuple, List, Dict, Any, FrozenSet, Iterator
 
 logger = logging.getLogger(__name__)
 
@@ -20,10 +23,150 @@ DB_PATH = DATA_DIR / "aimedbot.db"
 # Реферальные бонусы (можно переопределить через переменные окружения)
 REFERRAL_BONUS_DAYS = int(os.getenv("REFERRAL_BONUS_DAYS", "7"))       # сколько дней премиума за реферала
 REFERRAL_VOICE_WEEKS = int(os.getenv("REFERRAL_VOICE_WEEKS", "1"))     # на будущее: голосовой коуч
+
 # Бонус к лимиту сообщений за каждого реферала (используется в main.py через config, но оставим тут как инфо)
 # REFERRAL_DAILY_BONUS читается в main.py из bot.config или через getattr
 
 
+def _parse_admin_ids(raw: str) -> FrozenSet[int]:
+    # при любом мусоре в переменной считаем, что админов нет (как и раньше)
+    try:
+        return frozenset(int(x.strip()) for x in raw.split(",") if x.strip())
+    except ValueError:
+        return frozenset()
+
+
+# Версия схемы БД (PRAGMA user_version): увеличивать при добавлении миграций в _init_db
+SCHEMA_VERSION = 2
+
+# Процессный кэш пользователей: болтливые пользователи не ходят в SQLite на каждое сообщение
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "30"))
+USER_CACHE_SIZE = 1024
+
+# Админы: ADMIN_USER_IDS="1,2,3"
+ADMIN_USER_IDS: FrozenSet[int] = _parse_admin_ids(os.getenv("ADMIN_USER_IDS", ""))
+
+# --------------- SQL горячих путей ---------------
+# Держим тексты запросов константами: sqlite3 кэширует подготовленные выражения по тексту SQL
+
+_SQL_FETCH_USER = "SELECT * FROM users WHERE id = ?"
+
+_SQL_UPSERT_USER = """
+INSERT INTO users (
+    id,
+    username, first_name, last_name, is_bot,
+    mode_key, plan_code,
+    premium_until,
+    daily_used, monthly_used,
+    total_requests, total_tokens,
+    daily_date, monthly_month,
+    ref_code, referrals_count, referrer_user_id,
+    referral_rewards,
+    last_invoice_id, last_tariff_key,
+    style_hint,
+    last_summary_date,
+    created_at, updated_at
+)
+VALUES (
+    :id,
+    :username, :first_name, :last_name, :is_bot,
+    :mode_key, :plan_code,
+    :premium_until,
+    :daily_used, :monthly_used,
+    :total_requests, :total_tokens,
+    :daily_date, :monthly_month,
+    :ref_code, :referrals_count, :referrer_user_id,
+    :referral_rewards,
+    :last_invoice_id, :last_tariff_key,
+    :style_hint,
+    :last_summary_date,
+    :created_at, :updated_at
+)
+ON CONFLICT(id) DO UPDATE SET
+    username         = excluded.username,
+    first_name       = excluded.first_name,
+    last_name        = excluded.last_name,
+    is_bot           = excluded.is_bot,
+    mode_key         = excluded.mode_key,
+    plan_code        = excluded.plan_code,
+    premium_until    = excluded.premium_until,
+    daily_used       = excluded.daily_used,
+    monthly_used     = excluded.monthly_used,
+    total_requests   = excluded.total_requests,
+    total_tokens     = excluded.total_tokens,
+    daily_date       = excluded.daily_date,
+    monthly_month    = excluded.monthly_month,
+    ref_code         = excluded.ref_code,
+    referrals_count  = excluded.referrals_count,
+    referrer_user_id = excluded.referrer_user_id,
+    referral_rewards = excluded.referral_rewards,
+    last_invoice_id  = excluded.last_invoice_id,
+    last_tariff_key  = excluded.last_tariff_key,
+    style_hint       = excluded.style_hint,
+    last_summary_date = excluded.last_summary_date,
+    updated_at       = excluded.updated_at
+"""
+
+_SQL_GET_OR_CREATE_USER = """
+INSERT INTO users (
+    id,
+    username, first_name, last_name, is_bot,
+    mode_key, plan_code,
+    ref_code,
+    daily_date, monthly_month,
+    created_at, updated_at
+)
+VALUES (
+    :id,
+    :username, :first_name, :last_name, :is_bot,
+    'universal', 'free',
+    :ref_code,
+    :today, :month,
+    :now, :now
+)
+ON CONFLICT(id) DO UPDATE SET
+    daily_used    = CASE WHEN daily_date IS :today THEN daily_used ELSE 0 END,
+    daily_date    = :today,
+    monthly_used  = CASE WHEN monthly_month IS :month THEN monthly_used ELSE 0 END,
+    monthly_month = :month,
+    updated_at    = CASE
+        WHEN daily_date IS :today AND monthly_month IS :month THEN updated_at
+        ELSE :now
+    END
+RETURNING *, (created_at = :now) AS created
+"""
+
+_SQL_APPLY_USAGE = """
+UPDATE users SET
+    total_requests = total_requests + 1,
+    total_tokens   = total_tokens + :tokens,
+    daily_used     = CASE WHEN daily_date IS :today THEN daily_used + 1 ELSE 1 END,
+    daily_date     = :today,
+    monthly_used   = CASE WHEN monthly_month IS :month THEN monthly_used + 1 ELSE 1 END,
+    monthly_month  = :month,
+    updated_at     = :now
+WHERE id = :id
+RETURNING *
+"""
+
+_SQL_ADD_PREMIUM_DAYS = """
+UPDATE users SET
+    premium_until = date(
+        MAX(COALESCE(date(premium_until), :today), :today),
+        '+' || :days || ' days'
+    ),
+    plan_code  = CASE WHEN plan_code = 'admin' THEN plan_code ELSE 'premium' END,
+    updated_at = :now
+WHERE id = :id
+RETURNING *
+"""
+
+_SQL_LOG_MESSAGE = """
+INSERT INTO messages (user_id, role, content, created_at)
+VALUES (?, ?, ?, ?)
+"""
+
+
 @dataclass
 class UserRecord:
     id: int
@@ -100,14 +243,42 @@ class UserRecord:
 class Storage:
     def __init__(self, db_path: Path = DB_PATH) -> None:
         self.db_path = db_path
-        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._conn = sqlite3.connect(
+            str(self.db_path),
+            check_same_thread=False,
+            cached_statements=256,
+        )
         self._conn.row_factory = sqlite3.Row
+        self._tx_depth = 0
+        # user_id -> (время записи в кэш, UserRecord); порядок — LRU
+        self._user_cache: "OrderedDict[int, Tuple[float, UserRecord]]" = OrderedDict()
+        self._configure_connection()
         self._init_db()
 
     # --------------- Базовая схема БД ---------------
 
+    def _configure_connection(self) -> None:
+        """
+        WAL + synchronous=NORMAL: commit не ждёт fsync на каждую запись, а чтения
+        не блокируются записью. journal_mode сохраняется в файле БД, остальное действует
+        на это соединение. mmap: горячие страницы читаются прямо из отображённого файла,
+        без копирования через read().
+        """
+        conn = self._conn
+        mode = conn.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+        if str(mode).lower() != "wal":
+            # например, БД на сетевой ФС — работаем дальше в прежнем режиме журнала
+            logger.warning("SQLite WAL not enabled, journal_mode=%s", mode)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-20000")
+        conn.execute("PRAGMA mmap_size=268435456")
+
     def _init_db(self) -> None:
         cur = self._conn.cursor()
+        # Вся схема — одной транзакцией: один commit вместо отдельного на каждый DDL
+        cur.execute("BEGIN")
 
         # Пользователи
         cur.execute(
@@ -150,19 +321,23 @@ class Storage:
             """
         )
 
-        # Лёгкая миграция: гарантируем наличие новых колонок в уже существующей БД
-        cur.execute("PRAGMA table_info(users)")
-        cols = [r["name"] for r in cur.fetchall()]
-        if "last_summary_date" not in cols:
-            try:
-                cur.execute("ALTER TABLE users ADD COLUMN last_summary_date TEXT")
-            except Exception:
-                logger.exception("Failed to add last_summary_date column to users")
-        if "referral_rewards" not in cols:
-            try:
-                cur.execute("ALTER TABLE users ADD COLUMN referral_rewards TEXT")
-            except Exception:
-                logger.exception("Failed to add referral_rewards column to users")
+        # Лёгкая миграция: гарантируем наличие новых колонок в уже существующей БД.
+        # Версия схемы хранится в PRAGMA user_version — после первого прогона проверка O(1)
+        cur.execute("PRAGMA user_version")
+        user_version = cur.fetchone()[0]
+        if user_version < 1:
+            cur.execute("PRAGMA table_info(users)")
+            cols = [r["name"] for r in cur.fetchall()]
+            if "last_summary_date" not in cols:
+                try:
+                    cur.execute("ALTER TABLE users ADD COLUMN last_summary_date TEXT")
+                except Exception:
+                    logger.exception("Failed to add last_summary_date column to users")
+            if "referral_rewards" not in cols:
+                try:
+                    cur.execute("ALTER TABLE users ADD COLUMN referral_rewards TEXT")
+                except Exception:
+                    logger.exception("Failed to add referral_rewards column to users")
 
         # Сообщения
         cur.execute(
@@ -182,6 +357,16 @@ class Storage:
             "CREATE INDEX IF NOT EXISTS idx_messages_user_ts "
             "ON messages(user_id, created_at)"
         )
+        # get_messages_for_date берёт только role = 'user' — частичный индекс по этим строкам:
+        # ответы ассистента в него не пишутся, тела сообщений не копируются
+        cur.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_messages_user_msgs_ts'"
+        )
+        need_analyze = cur.fetchone() is None
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS idx_messages_user_msgs_ts "
+            "ON messages(user_id, created_at) WHERE role = 'user'"
+        )
 
         # Дневные summary
         cur.execute(
@@ -198,6 +383,33 @@ class Storage:
             """
         )
 
+        # Счета CryptoBot: invoice_id -> (user_id, tariff_key) и статус.
+        # По этой таблице webhook находит владельца счёта, а status = 'paid'
+        # не даёт начислить premium за один счёт дважды
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS invoices (
+                invoice_id INTEGER PRIMARY KEY,
+                user_id    INTEGER NOT NULL,
+                tariff_key TEXT,
+                status     TEXT NOT NULL DEFAULT 'pending',  -- 'pending' / 'paid'
+                created_at REAL NOT NULL,
+                paid_at    REAL,
+                FOREIGN KEY (user_id) REFERENCES users(id)
+            )
+            """
+        )
+        if user_version < 2:
+            # счета, выставленные до появления таблицы, известны только как last_invoice_id
+            cur.execute(
+                """
+                INSERT OR IGNORE INTO invoices (invoice_id, user_id, tariff_key, created_at)
+                SELECT last_invoice_id, id, last_tariff_key, updated_at
+                FROM users
+                WHERE last_invoice_id IS NOT NULL
+                """
+            )
+
         # Проекты пользователя (слой проектов/тем)
         cur.execute(
             """
@@ -217,10 +429,59 @@ class Storage:
             "ON projects(user_id, last_used_ts)"
         )
 
+        if user_version < SCHEMA_VERSION:
+            cur.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
         self._conn.commit()
 
+        # Статистика для планировщика — один раз, когда индекс только что появился
+        if need_analyze:
+            self._conn.execute("ANALYZE")
+            self._conn.commit()
+
+    # --------------- Обслуживание ---------------
+
+    def optimize(self) -> None:
+        """
+        PRAGMA optimize: SQLite сам решает, для каких индексов обновить статистику (ANALYZE),
+        чтобы планировщик не промахивался с индексом по мере роста messages.
+        """
+        self._conn.execute("PRAGMA optimize")
+
+    def close(self) -> None:
+        """Закрывает соединение; перед этим — PRAGMA optimize, как рекомендует SQLite."""
+        try:
+            self.optimize()
+        except sqlite3.Error as e:
+            logger.warning("PRAGMA optimize failed: %s", e)
+        self._conn.close()
+
     # --------------- Внутренние утилиты ---------------
 
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        """
+        Группирует несколько записей в одну транзакцию (один commit вместо нескольких).
+        Можно вкладывать: фиксируется только самый внешний блок, при ошибке — rollback.
+        """
+        self._tx_depth += 1
+        try:
+            yield
+        except BaseException:
+            self._tx_depth -= 1
+            if not self._tx_depth:
+                self._conn.rollback()
+                # в кэше могли остаться изменения из откатанной транзакции
+                self._user_cache.clear()
+            raise
+        self._tx_depth -= 1
+        if not self._tx_depth:
+            self._conn.commit()
+
+    def _commit(self) -> None:
+        # внутри transaction() коммит откладывается до выхода из внешнего блока
+        if not self._tx_depth:
+            self._conn.commit()
+
     def _now_ts(self) -> float:
         return time.time()
 
@@ -234,9 +495,27 @@ class Storage:
         # простой детерминированный код, можно потом заменить на более сложный
         return f"BB{user_id}"
 
+    def _cache_get(self, user_id: int) -> Optional[UserRecord]:
+        entry = self._user_cache.get(user_id)
+        if entry is None:
+            return None
+        cached_at, user = entry
+        if time.monotonic() - cached_at > USER_CACHE_TTL:
+            del self._user_cache[user_id]
+            return None
+        self._user_cache.move_to_end(user_id)
+        # отдаём копию: хендлеры меняют UserRecord на месте
+        return copy.copy(user)
+
+    def _cache_put(self, user: UserRecord) -> None:
+        self._user_cache[user.id] = (time.monotonic(), copy.copy(user))
+        self._user_cache.move_to_end(user.id)
+        while len(self._user_cache) > USER_CACHE_SIZE:
+            self._user_cache.popitem(last=False)
+
     def _fetch_user_row(self, user_id: int) -> Optional[sqlite3.Row]:
         cur = self._conn.cursor()
-        cur.execute("SELECT * FROM users WHERE id = ?", (user_id,))
+        cur.execute(_SQL_FETCH_USER, (user_id,))
         return cur.fetchone()
 
     def _upsert_user(self, user: UserRecord) -> None:
@@ -248,61 +527,7 @@ class Storage:
         user.updated_at = now_ts
 
         cur.execute(
-            """
-            INSERT INTO users (
-                id,
-                username, first_name, last_name, is_bot,
-                mode_key, plan_code,
-                premium_until,
-                daily_used, monthly_used,
-                total_requests, total_tokens,
-                daily_date, monthly_month,
-                ref_code, referrals_count, referrer_user_id,
-                referral_rewards,
-                last_invoice_id, last_tariff_key,
-                style_hint,
-                last_summary_date,
-                created_at, updated_at
-            )
-            VALUES (
-                :id,
-                :username, :first_name, :last_name, :is_bot,
-                :mode_key, :plan_code,
-                :premium_until,
-                :daily_used, :monthly_used,
-                :total_requests, :total_tokens,
-                :daily_date, :monthly_month,
-                :ref_code, :referrals_count, :referrer_user_id,
-                :referral_rewards,
-                :last_invoice_id, :last_tariff_key,
-                :style_hint,
-                :last_summary_date,
-                :created_at, :updated_at
-            )
-            ON CONFLICT(id) DO UPDATE SET
-                username         = excluded.username,
-                first_name       = excluded.first_name,
-                last_name        = excluded.last_name,
-                is_bot           = excluded.is_bot,
-                mode_key         = excluded.mode_key,
-                plan_code        = excluded.plan_code,
-                premium_until    = excluded.premium_until,
-                daily_used       = excluded.daily_used,
-                monthly_used     = excluded.monthly_used,
-                total_requests   = excluded.total_requests,
-                total_tokens     = excluded.total_tokens,
-                daily_date       = excluded.daily_date,
-                monthly_month    = excluded.monthly_month,
-                ref_code         = excluded.ref_code,
-                referrals_count  = excluded.referrals_count,
-                referrer_user_id = excluded.referrer_user_id,
-                referral_rewards = excluded.referral_rewards,
-                last_invoice_id  = excluded.last_invoice_id,
-                last_tariff_key  = excluded.last_tariff_key,
-                style_hint       = excluded.style_hint,
-                last_summary_date = excluded.last_summary_date,
-                updated_at       = excluded.updated_at
-            """,
+            _SQL_UPSERT_USER,
             {
                 "id": user.id,
                 "username": user.username,
@@ -330,7 +555,8 @@ class Storage:
                 "updated_at": user.updated_at,
             },
         )
-        self._conn.commit()
+        self._commit()
+        self._cache_put(user)
 
     # --------------- Публичный API ---------------
 
@@ -338,44 +564,43 @@ class Storage:
         """
         Возвращает (UserRecord, created)
         tg_user — объект aiogram.types.User (или любой с теми же полями).
-        """
-        row = self._fetch_user_row(user_id)
-        created = False
-        if row:
-            user = UserRecord.from_row(row)
-        else:
-            created = True
-            user = UserRecord(
-                id=user_id,
-                username=getattr(tg_user, "username", None),
-                first_name=getattr(tg_user, "first_name", None),
-                last_name=getattr(tg_user, "last_name", None),
-                is_bot=bool(getattr(tg_user, "is_bot", False)),
-                mode_key="universal",
-                plan_code="free",
-            )
-            # ref_code генерируем сразу
-            user.ref_code = self._generate_ref_code(user_id)
-            self._upsert_user(user)
 
-        # сброс дневных/месячных лимитов, если нужна дата/месяц
-        today = self._today_key()
-        month = self._month_key()
-        changed = False
-
-        if user.daily_date != today:
-            user.daily_date = today
-            user.daily_used = 0
-            changed = True
-
-        if user.monthly_month != month:
-            user.monthly_month = month
-            user.monthly_used = 0
-            changed = True
+        Один UPSERT ... RETURNING вместо SELECT + INSERT + UPDATE:
+        новый пользователь создаётся сразу с ref_code, у существующего
+        в том же запросе сбрасываются дневные/месячные счётчики при смене даты/месяца.
+        """
+        cached = self._cache_get(user_id)
+        if (
+            cached is not None
+            and cached.daily_date == self._today_key()
+            and cached.monthly_month == self._month_key()
+        ):
+            # дата/месяц не сменились — сбрасывать счётчики не нужно, БД не трогаем
+            return cached, False
 
-        if changed:
-            self._upsert_user(user)
+        now_ts = self._now_ts()
+        cur = self._conn.cursor()
+        cur.execute(
+            _SQL_GET_OR_CREATE_USER,
+            {
+                "id": user_id,
+                "username": getattr(tg_user, "username", None),
+                "first_name": getattr(tg_user, "first_name", None),
+                "last_name": getattr(tg_user, "last_name", None),
+                "is_bot": int(bool(getattr(tg_user, "is_bot", False))),
+                "ref_code": self._generate_ref_code(user_id),
+                "today": self._today_key(),
+                "month": self._month_key(),
+                "now": now_ts,
+            },
+        )
+        row = cur.fetchall()[0]
+        self._commit()
 
+        # created_at выставляется только при вставке — признак новой записи считает сам SQLite
+        created = bool(row["created"])
+        user = UserRecord.from_row(row)
+        self._cache_put(user)
         return user, created
 
     def save_user(self, user: UserRecord) -> None:
@@ -408,24 +633,37 @@ class Storage:
     def apply_usage(self, user: UserRecord, tokens_used: int) -> None:
         """
         Обновляет счётчики использования.
+        Инкремент делается атомарно в SQL (UPDATE ... RETURNING), без перезаписи всей строки;
+        свежие значения счётчиков сразу возвращаются в user.
         """
-        user.total_requests += 1
-        user.total_tokens += int(tokens_used or 0)
-
-        # гарантируем актуальные дата/месяц
         today = self._today_key()
         month = self._month_key()
-        if user.daily_date != today:
-            user.daily_date = today
-            user.daily_used = 0
-        if user.monthly_month != month:
-            user.monthly_month = month
-            user.monthly_used = 0
-
-        user.daily_used += 1
-        user.monthly_used += 1
+        cur = self._conn.cursor()
+        cur.execute(
+            _SQL_APPLY_USAGE,
+            {
+                "id": user.id,
+                "tokens": int(tokens_used or 0),
+                "today": today,
+                "month": month,
+                "now": self._now_ts(),
+            },
+        )
+        rows = cur.fetchall()
+        self._commit()
+        if not rows:
+            return
 
-        self._upsert_user(user)
+        # в кэш — строка из БД, а не запись вызывающего (см. add_premium_days)
+        fresh = UserRecord.from_row(rows[0])
+        user.total_requests = fresh.total_requests
+        user.total_tokens = fresh.total_tokens
+        user.daily_used = fresh.daily_used
+        user.daily_date = fresh.daily_date
+        user.monthly_used = fresh.monthly_used
+        user.monthly_month = fresh.monthly_month
+        user.updated_at = fresh.updated_at
+        self._cache_put(fresh)
 
     # --- режимы ---
 
@@ -442,13 +680,10 @@ class Storage:
     def log_message(self, user_id: int, role: str, content: str) -> None:
         cur = self._conn.cursor()
         cur.execute(
-            """
-            INSERT INTO messages (user_id, role, content, created_at)
-            VALUES (?, ?, ?, ?)
-            """,
+            _SQL_LOG_MESSAGE,
             (user_id, role, content, self._now_ts()),
         )
-        self._conn.commit()
+        self._commit()
 
     # --- дневной дневник / summary ---
 
@@ -464,7 +699,7 @@ class Storage:
             """,
             (user_id, date_str, summary, self._now_ts()),
         )
-        self._conn.commit()
+        self._commit()
 
     def get_daily_summary(self, user_id: int, date_str: str) -> Optional[str]:
         cur = self._conn.cursor()
@@ -534,6 +769,7 @@ class Storage:
         - увеличить referrals_count у реферера;
         - записать referral_rewards;
         - опционально выдать дни премиума за реферала.
+        Все записи идут одной транзакцией.
         """
         cur = self._conn.cursor()
         cur.execute(
@@ -548,36 +784,98 @@ class Storage:
         if referrer_id == new_user_id:
             return
 
-        # обновляем счётчик у реферера
-        referrer = UserRecord.from_row(row)
-        referrer.referrals_count += 1
+        with self.transaction():
+            # обновляем счётчик у реферера
+            referrer = UserRecord.from_row(row)
+            referrer.referrals_count += 1
 
-        rewards = self._get_referral_rewards_dict(referrer)
-        rewards["referrals_total"] = referrer.referrals_count
-        rewards["bonus_premium_days"] = rewards.get("bonus_premium_days", 0) + max(0, REFERRAL_BONUS_DAYS)
-        rewards["bonus_voice_weeks"] = rewards.get("bonus_voice_weeks", 0) + max(0, REFERRAL_VOICE_WEEKS)
-        self._set_referral_rewards_dict(referrer, rewards)
+            rewards = self._get_referral_rewards_dict(referrer)
+            rewards["referrals_total"] = referrer.referrals_count
+            rewards["bonus_premium_days"] = rewards.get("bonus_premium_days", 0) + max(0, REFERRAL_BONUS_DAYS)
+            rewards["bonus_voice_weeks"] = rewards.get("bonus_voice_weeks", 0) + max(0, REFERRAL_VOICE_WEEKS)
+            self._set_referral_rewards_dict(referrer, rewards)
 
-        # Начисляем премиум-дни за реферала (если >0)
-        if REFERRAL_BONUS_DAYS > 0:
-            self.add_premium_days(referrer, REFERRAL_BONUS_DAYS)
-        else:
+            # Сохраняем счётчик/награды и начисляем премиум-дни за реферала (если >0)
             self._upsert_user(referrer)
+            if REFERRAL_BONUS_DAYS > 0:
+                self.add_premium_days(referrer, REFERRAL_BONUS_DAYS)
 
-        # и сохраняем referrer_user_id у нового пользователя, если он уже есть
-        row_new = self._fetch_user_row(new_user_id)
-        if row_new:
-            new_user = UserRecord.from_row(row_new)
-            if not new_user.referrer_user_id:
-                new_user.referrer_user_id = referrer_id
-                self._upsert_user(new_user)
+            # и сохраняем referrer_user_id у нового пользователя, если он уже есть
+            row_new = self._fetch_user_row(new_user_id)
+            if row_new:
+                new_user = UserRecord.from_row(row_new)
+                if not new_user.referrer_user_id:
+                    new_user.referrer_user_id = referrer_id
+                    self._upsert_user(new_user)
 
     # --- подписка и оплаты ---
 
     def store_invoice(self, user: UserRecord, invoice_id: int, tariff_key: str) -> None:
-        user.last_invoice_id = int(invoice_id)
-        user.last_tariff_key = tariff_key
-        self._upsert_user(user)
+        with self.transaction():
+            self._conn.execute(
+                """
+                INSERT OR IGNORE INTO invoices (invoice_id, user_id, tariff_key, created_at)
+                VALUES (?, ?, ?, ?)
+                """,
+                (int(invoice_id), user.id, tariff_key, self._now_ts()),
+            )
+            user.last_invoice_id = int(invoice_id)
+            user.last_tariff_key = tariff_key
+            self._upsert_user(user)
+
+    def find_invoice(self, invoice_id: int) -> Optional[Tuple[UserRecord, Optional[str]]]:
+        """Владелец счёта и тариф, под который счёт выставлен (None — счёт не наш)."""
+        cur = self._conn.cursor()
+        cur.execute(
+            "SELECT user_id, tariff_key FROM invoices WHERE invoice_id = ?",
+            (int(invoice_id),),
+        )
+        row = cur.fetchone()
+        if not row:
+            return None
+        user_row = self._fetch_user_row(row["user_id"])
+        if not user_row:
+            return None
+        return UserRecord.from_row(user_row), row["tariff_key"]
+
+    def is_invoice_paid(self, invoice_id: int) -> bool:
+        """Счёт уже засчитан (webhook'ом или ручной проверкой)."""
+        cur = self._conn.cursor()
+        cur.execute(
+            "SELECT 1 FROM invoices WHERE invoice_id = ? AND status = 'paid'",
+            (int(invoice_id),),
+        )
+        return cur.fetchone() is not None
+
+    def activate_paid_invoice(
+        self,
+        user: UserRecord,
+        invoice_id: int,
+        tariff_key: Optional[str],
+        months: int,
+    ) -> bool:
+        """
+        Отмечает счёт оплаченным и продлевает premium — одной транзакцией.
+        Возвращает False, если этот счёт уже был засчитан раньше (повторный webhook/проверка).
+        """
+        now_ts = self._now_ts()
+        with self.transaction():
+            cur = self._conn.cursor()
+            cur.execute(
+                """
+                INSERT INTO invoices (invoice_id, user_id, tariff_key, status, created_at, paid_at)
+                VALUES (?, ?, ?, 'paid', ?, ?)
+                ON CONFLICT(invoice_id) DO UPDATE SET
+                    status  = 'paid',
+                    paid_at = excluded.paid_at
+                WHERE invoices.status != 'paid'
+                """,
+                (int(invoice_id), user.id, tariff_key, now_ts, now_ts),
+            )
+            if cur.rowcount == 0:
+                return False
+            self.activate_premium(user, months)
+        return True
 
     def get_last_invoice(self, user: UserRecord) -> Tuple[Optional[int], Optional[str]]:
         return user.last_invoice_id, user.last_tariff_key
@@ -586,28 +884,37 @@ class Storage:
         """
         Добавляет пользователю N дней премиума (используется тарифами и рефералкой).
         premium_until — YYYY-MM-DD
+
+        Новая дата считается прямо в UPDATE: max(сегодня, текущий premium_until) + N дней,
+        без предварительного чтения строки. Некорректная дата в БД трактуется как «сегодня».
         """
         if days <= 0:
             # всё равно сохраним user (например, если только referral_rewards поменялись)
             self._upsert_user(user)
             return
 
-        today = date.today()
-        if user.premium_until:
-            try:
-                current = datetime.strptime(user.premium_until, "%Y-%m-%d").date()
-            except Exception:
-                current = today
-        else:
-            current = today
-
-        base = max(today, current)
-        new_date = base + timedelta(days=days)
-        user.premium_until = new_date.strftime("%Y-%m-%d")
-        if user.plan_code != "admin":
-            user.plan_code = "premium"
+        cur = self._conn.cursor()
+        cur.execute(
+            _SQL_ADD_PREMIUM_DAYS,
+            {
+                "id": user.id,
+                "today": date.today().strftime("%Y-%m-%d"),
+                "days": int(days),
+                "now": self._now_ts(),
+            },
+        )
+        rows = cur.fetchall()
+        self._commit()
+        if not rows:
+            return
 
-        self._upsert_user(user)
+        # UPDATE пишет только поля премиума: в кэш кладём строку из БД, а не запись
+        # вызывающего — его несохранённые правки не должны выглядеть сохранёнными
+        fresh = UserRecord.from_row(rows[0])
+        user.premium_until = fresh.premium_until
+        user.plan_code = fresh.plan_code
+        user.updated_at = fresh.updated_at
+        self._cache_put(fresh)
 
     def activate_premium(self, user: UserRecord, months: int) -> None:
         """
@@ -624,12 +931,6 @@ class Storage:
         """
         Проверка админов через переменную окружения ADMIN_USER_IDS="1,2,3".
         Чтобы не тащить config и не создавать циклических импортов.
+        Список разбирается один раз при импорте модуля.
         """
-        raw = os.getenv("ADMIN_USER_IDS", "")
-        if not raw:
-            return False
-        try:
-            ids = {int(x.strip()) for x in raw.split(",") if x.strip()}
-        except ValueError:
-            return False
-        return user_id in ids
+        return user_id in ADMIN_USER_IDS
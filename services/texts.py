@@ -41,30 +41,38 @@ def _humanize_int(value: int) -> str:
 # =========================
 #  Онбординг / старт
 # =========================
+# Шаблоны экрана /start: собираются один раз при импорте, в хендлере — один format_map
+_ONBOARDING_NEW_HEAD = (
+    "Привет, *{first_name}* 👋\n\n"
+    "Я — *Black Box GPT*, твой универсальный ИИ-ассистент.\n\n"
+)
+_ONBOARDING_RETURN_HEAD = (
+    "С возвращением, *{first_name}* 🔁\n\n"
+    "Продолжаем работу.\n\n"
+)
+_ONBOARDING_BODY = (
+    "*Текущий тариф:* `{plan_title}`\n"
+    "*Режим:* `{mode_title}`\n\n"
+    "👇 Используй нижний таскбар, чтобы:\n"
+    "• переключать режимы\n"
+    "• смотреть профиль и лимиты\n"
+    "• оформлять подписку и рефералки\n\n"
+    "А можешь просто написать свой запрос — от медицины и бизнеса "
+    "до личного развития и креатива."
+)
+_ONBOARDING_NEW_TMPL = _ONBOARDING_NEW_HEAD + _ONBOARDING_BODY
+_ONBOARDING_RETURN_TMPL = _ONBOARDING_RETURN_HEAD + _ONBOARDING_BODY
+
+
 def render_onboarding(
     first_name: str,
     is_new: bool,
     plan_title: str,
     mode_title: str,
 ) -> str:
-    if is_new:
-        prefix = f"Привет, *{first_name}* 👋\n\n"
-        middle = "Я — *Black Box GPT*, твой универсальный ИИ-ассистент.\n\n"
-    else:
-        prefix = f"С возвращением, *{first_name}* 🔁\n\n"
-        middle = "Продолжаем работу.\n\n"
-
-    return (
-        prefix
-        + middle
-        + f"*Текущий тариф:* `{plan_title}`\n"
-        + f"*Режим:* `{mode_title}`\n\n"
-        + "👇 Используй нижний таскбар, чтобы:\n"
-        + "• переключать режимы\n"
-        + "• смотреть профиль и лимиты\n"
-        + "• оформлять подписку и рефералки\n\n"
-        + "А можешь просто написать свой запрос — от медицины и бизнеса "
-          "до личного развития и креатива."
+    template = _ONBOARDING_NEW_TMPL if is_new else _ONBOARDING_RETURN_TMPL
+    return template.format_map(
+        {"first_name": first_name, "plan_title": plan_title, "mode_title": mode_title}
     )
 
 
@@ -193,39 +201,34 @@ def render_mode_switched(mode_title: str) -> str:
 # =========================
 #  Подписка / оплата
 # =========================
+# Статичная часть экрана подписки: лимиты и тарифы не меняются после старта,
+# поэтому собираем её один раз при импорте, а не на каждое нажатие «Подписка»
+_SUBSCRIPTION_OVERVIEW_TAIL = (
+    "*Ограничения базового тарифа:*\n"
+    f"• {FREE_DAILY_LIMIT} запросов в день / {FREE_MONTHLY_LIMIT} в месяц\n\n"
+    "*Что даёт Premium:*\n"
+    f"• Лимиты: {PREMIUM_DAILY_LIMIT} запросов в день / {PREMIUM_MONTHLY_LIMIT} в месяц\n"
+    "• Приоритетная обработка\n"
+    "• Более длинные и детальные ответы\n\n"
+    "👇 Выбери вариант подписки внизу, чтобы получить ссылку на оплату."
+)
+_SUBSCRIPTION_BASE_PLAN_LINE = "У тебя сейчас базовый тариф.\n\n"
+
+
 def render_subscription_overview(
     plan_title: str,
     premium_until: Optional[datetime],
 ) -> str:
-    has_premium = premium_until is not None
-
-    base_limits = (
-        f"{FREE_DAILY_LIMIT} запросов в день / "
-        f"{FREE_MONTHLY_LIMIT} в месяц"
-    )
-    premium_limits = (
-        f"{PREMIUM_DAILY_LIMIT} запросов в день / "
-        f"{PREMIUM_MONTHLY_LIMIT} в месяц"
-    )
-
-    if has_premium:
-        premium_str = (
-            f"Премиум активен до *{_fmt_date(premium_until)}* ✅\n\n"
-        )
+    if premium_until is not None:
+        premium_str = f"Премиум активен до *{_fmt_date(premium_until)}* ✅\n\n"
     else:
-        premium_str = "У тебя сейчас базовый тариф.\n\n"
+        premium_str = _SUBSCRIPTION_BASE_PLAN_LINE
 
     return (
         "💎 *Подписка Black Box GPT*\n\n"
         f"*Текущий тариф:* `{plan_title}`\n"
         + premium_str
-        + "*Ограничения базового тарифа:*\n"
-        f"• {base_limits}\n\n"
-        "*Что даёт Premium:*\n"
-        f"• Лимиты: {premium_limits}\n"
-        "• Приоритетная обработка\n"
-        "• Более длинные и детальные ответы\n\n"
-        "👇 Выбери вариант подписки внизу, чтобы получить ссылку на оплату."
+        + _SUBSCRIPTION_OVERVIEW_TAIL
     )
 
 